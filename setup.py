@@ -7,7 +7,6 @@ setup(
     },
     install_requires=[
         "python-lzo>=1.11",
-        "crcmod>=1.7",
     ],
     py_modules=['ubidump'],
     author = "Willem Hengeveld",
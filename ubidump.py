@@ -5,17 +5,21 @@ Tool for listing and extracting data from an UBI (Unsorted Block Image) image.
 (C) 2017 by Willem Hengeveld <itsme@xs4all.nl>
 """
 from __future__ import division, print_function
-import crcmod.predefined
 import argparse
 import struct
 from binascii import b2a_hex
 import lzo
 import zlib
 import os
+import mmap
 import errno
 import datetime
 import sys
-from collections import defaultdict
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import array
+from bisect import bisect_left
 
 import pkg_resources
 
@@ -40,7 +44,6 @@ if sys.version_info[0] == 2:
 
 dependencies = [
     'python-lzo>=1.11',
-    'crcmod>=1.7'
 ]
 
 pkg_resources.require(dependencies)
@@ -50,16 +53,25 @@ if sys.version_info[0] == 3:
     def cmp(a,b):
         return (a>b) - (a<b)
 
-# using crcmod to generate the correct crc function.
-crc32 = crcmod.predefined.mkPredefinedCrcFun('CrcJamCrc')
+def crc32(data, crc=0xFFFFFFFF):
+    """
+    ubi uses the 'jamcrc' variant: the standard crc32 without the final complement.
+
+    pass the crc of the preceeding data in `crc` to continue a running crc.
+    """
+    return ~zlib.crc32(data, ~crc & 0xFFFFFFFF) & 0xFFFFFFFF
 
 
 class SeekableStdout:
     """
     Wrapper for stdout, which allows forward seeking.
+
+    Data is written directly to the binary stdout buffer.
     """
     def __init__(self):
         self.pos = 0
+        # make sure text printed earlier comes before the data.
+        sys.stdout.flush()
 
     def seek(self, newpos, whence=os.SEEK_SET):
         if whence==os.SEEK_SET:
@@ -84,7 +96,6 @@ class SeekableStdout:
         """
         Seek forward by writing NUL bytes.
         """
-        sys.stdout.flush()
         chunk = b"\x00" * 0x10000
         while size > 0:
             if len(chunk) > size:
@@ -93,7 +104,6 @@ class SeekableStdout:
             size -= len(chunk)
 
     def write(self, data):
-        sys.stdout.flush()
         stdout.write(data)
         self.pos += len(data)
 
@@ -106,6 +116,10 @@ class SeekableStdout:
 
 ########### block level objects ############
 
+_EC_S = struct.Struct(">4sB3xQLLL32xL")
+_VID_S = struct.Struct(">4s4BLL4x4L4xQ12xL")
+_VTBL_S = struct.Struct(">3LBBH128sB23xL")
+
 class UbiEcHeader:
     """
     The Erase count header
@@ -124,10 +138,10 @@ class UbiEcHeader:
         self.image_seq,   # L
                           # 32x
         hdr_crc,          # L
-        ) = struct.unpack(">4sB3xQLLL32xL", data)
+        ) = _EC_S.unpack_from(data, 0)
         if self.magic != b'UBI#':
             raise Exception("UBI# ec hdr magic num mismatch")
-        if hdr_crc != crc32(data[:-4]):
+        if hdr_crc != crc32(data[:self.hdrsize-4]):
             raise Exception("crc mismatch")
     def encode(self):
         data = struct.pack(">4sB3xQLLL32x", self.magic, self.version, self.erasecount, self.vid_hdr_ofs, self.data_ofs, \
@@ -167,10 +181,10 @@ class UbiVidHead:
         self.sqnum,        # Q
                            # 12x
         hdr_crc,           # L
-        )= struct.unpack(">4s4BLL4x4L4xQ12xL", data)
+        )= _VID_S.unpack_from(data, 0)
         if self.magic != b'UBI!':
             raise Exception("UBI! volid magic num mismatch")
-        if hdr_crc != crc32(data[:-4]):
+        if hdr_crc != crc32(data[:self.hdrsize-4]):
             raise Exception("crc mismatch")
 
     def encode(self):
@@ -209,8 +223,8 @@ class UbiVtblRecord:
         self.flags,         # B
                             # 23x
         crc,                # L
-        ) = struct.unpack(">3LBBH128sB23xL", data)
-        if crc != crc32(data[:-4]):
+        ) = _VTBL_S.unpack_from(data, 0)
+        if crc != crc32(data[:self.hdrsize-4]):
             raise Exception("crc mismatch")
         self.name = self.name[:name_len]
     def encode(self):
@@ -241,6 +255,9 @@ class UbiVolume:
         self.blks = blks
         self.volid = volid
         self.dataofs = dataofs
+        self.leb_size = blks.leb_size - dataofs
+        # reads are slices of a mmap, no seek+read
+        self.mapped = blks.mm is not None
 
     def read(self, lnum, offs, size):
         return self.blks.readvolume(self.volid, lnum, self.dataofs+offs, size)
@@ -264,6 +281,7 @@ class RawVolume:
     def __init__(self, fh):
         self.fh = fh
         self.leb_size = self.find_block_size()
+        self.mapped = False
 
     def read(self, lnum, offs, size):
         self.fh.seek(lnum*self.leb_size+offs)
@@ -295,6 +313,19 @@ class UbiBlocks:
     """
     def __init__(self, fh):
         self.fh = fh
+        if hasattr(os, 'posix_fadvise'):
+            # the image is mostly read from start to end, let the OS read ahead.
+            try:
+                os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                # not a regular file
+                pass
+        try:
+            # reading from a memory map avoids a seek + read syscall for every block read.
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # not a regular file, or an empty file: fall back to seek + read
+            self.mm = None
         self.leb_size = self.find_blocksize()
 
         fh.seek(0, os.SEEK_END)
@@ -306,7 +337,8 @@ class UbiBlocks:
         if not VTBL_VOLID in self.vmap:
             print("no volume directory, %d physical volumes" % len(self.vmap))
             return
-        self.scanvtbls(self.vmap[VTBL_VOLID][0])
+        # the volume table is stored twice, use the first copy found.
+        self.scanvtbls(next(physlnum for physlnum in self.vmap[VTBL_VOLID] if physlnum >= 0))
 
         print("%d named volumes found, %d physical volumes, blocksize=0x%x" % (self.nr_named, len(self.vmap), self.leb_size))
 
@@ -325,24 +357,65 @@ class UbiBlocks:
     def scanblocks(self):
         """
         creates map of volid + lnum => physical lnum
+
+        for each volume the map is an array indexed by lnum, with -1 for unmapped lebs.
         """
-        self.vmap = defaultdict(lambda : defaultdict(int))
+        self.vmap = {}
+
+        # read both headers with one read, initially assuming the vid header directly
+        # follows the ec header. This is extended when a block has a larger vid_hdr_ofs.
+        hdrlen = UbiEcHeader.hdrsize + UbiVidHead.hdrsize
+        self.prefetchheaders(hdrlen)
         for lnum in range(self.maxlebs):
+            hdr = self.readblock(lnum, 0, hdrlen)
+            if hdr[:4] != b'UBI#':
+                # erased block
+                continue
 
             try:
                 ec = UbiEcHeader()
-                hdr = self.readblock(lnum, 0, ec.hdrsize)
                 ec.parse(hdr)
 
                 vid = UbiVidHead()
-                viddata = self.readblock(lnum, ec.vid_hdr_ofs, vid.hdrsize)
-                vid.parse(viddata)
+                vidend = ec.vid_hdr_ofs + vid.hdrsize
+                if vidend > hdrlen:
+                    hdrlen = vidend
+                    hdr = self.readblock(lnum, 0, hdrlen)
+                if hdr[ec.vid_hdr_ofs:ec.vid_hdr_ofs+4] != b'UBI!':
+                    # block not used by any volume
+                    continue
+                vid.parse(hdr[ec.vid_hdr_ofs:vidend])
+            except Exception:
+                # corrupt or truncated header
+                continue
+
+            lmap = self.vmap.get(vid.vol_id)
+            if lmap is None:
+                lmap = self.vmap[vid.vol_id] = array.array('i', [-1]) * self.maxlebs
+            if vid.lnum >= len(lmap):
+                # in a truncated image, a volume can have more lebs than there are blocks in the file.
+                lmap.extend([-1] * (vid.lnum + 1 - len(lmap)))
+            lmap[vid.lnum] = lnum
+
+    def prefetchheaders(self, size):
+        """
+        Ask the OS to start reading the first `size` bytes of all blocks.
 
-                self.vmap[vid.vol_id][vid.lnum] = lnum
-            except:
-                pass
+        This way the reads for all blocks are issued in parallel, instead of
+        scanblocks waiting for each block in turn.
+        """
+        if self.mm is None or not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        pagemask = mmap.PAGESIZE - 1
+        for lnum in range(self.maxlebs):
+            o = lnum * self.leb_size
+            start = o & ~pagemask
+            self.mm.madvise(mmap.MADV_WILLNEED, start, o - start + size)
 
     def readblock(self, lnum, offs, size):
+        if self.mm is not None:
+            o = lnum * self.leb_size + offs
+            return self.mm[o:o+size]
         self.fh.seek(lnum * self.leb_size + offs)
         return self.fh.read(size)
 
@@ -399,7 +472,7 @@ class UbiBlocks:
                 print("  %s" % v)
 
         for volid, lmap in self.vmap.items():
-            print("volume %x : %d lebs" % (volid, len(lmap)))
+            print("volume %x : %d lebs" % (volid, len(lmap) - lmap.count(-1)))
 
     def nr_named(self):
         return self.nr_named
@@ -410,17 +483,20 @@ class UbiBlocks:
     def getvolume(self, volid):
         return UbiVolume(self, volid, self.ec.data_ofs)
 
-    def readvolume(self, volid, lnum, offs, size):
-        physlnum = self.vmap[volid].get(lnum, None)
-        if physlnum is None:
+    def physicallnum(self, volid, lnum):
+        """
+        translate a volume lnum to a physical lnum
+        """
+        lmap = self.vmap.get(volid)
+        if lmap is None or not 0 <= lnum < len(lmap) or lmap[lnum] < 0:
             raise Exception("volume does not contain lnum")
-        return self.readblock(physlnum, offs, size)
+        return lmap[lnum]
+
+    def readvolume(self, volid, lnum, offs, size):
+        return self.readblock(self.physicallnum(volid, lnum), offs, size)
 
     def writevolume(self, volid, lnum, offs, data):
-        physlnum = self.vmap[volid].get(lnum, None)
-        if physlnum is None:
-            raise Exception("volume does not contain lnum")
-        return self.writeblock(physlnum, offs, data)
+        return self.writeblock(self.physicallnum(volid, lnum), offs, data)
 
 
 
@@ -443,16 +519,28 @@ data:  <inum + blocknum
 trunc:  <inum>  + 0
 
 """
+_KEY_S = struct.Struct("<LL")
+
 def unpackkey(key):
     if len(key)==16 and key[8:]!=b'\x00'*8:
         print("key has more than 8 bytes: %s" % b2a_hex(key))
-    inum, value = struct.unpack("<LL", key[:8])
+    inum, value = _KEY_S.unpack_from(key, 0)
     return (inum, value>>29, value&0x1FFFFFFF)
 
 
 def packkey(key):
     inum, ityp, value = key
-    return struct.pack("<LL", inum, (ityp<<29) | value)
+    return _KEY_S.pack(inum, (ityp<<29) | value)
+
+
+def intkey(key):
+    """
+    convert a packed key to an integer which orders the same as the key tuple.
+
+    note that this is not the little endian qword: the inum has to be the most significant part.
+    """
+    inum, value = _KEY_S.unpack_from(key, 0)
+    return (inum<<32) | value
 
 
 def formatkey(key):
@@ -464,18 +552,15 @@ def formatkey(key):
 
 
 def comparekeys(lhs, rhs):
-    return cmp(unpackkey(lhs), unpackkey(rhs))
+    return cmp(intkey(lhs), intkey(rhs))
 
 
 def namehash(name):
+    if not isinstance(name, bytes):
+        name = name.encode('utf-8')
     a = 0
     for b in name:
-        if type(b)==str: b = ord(b)
-        a += b<<4
-        a += b>>4
-        a &= 0xFFFFFFFF
-        a *= 11
-        a &= 0xFFFFFFFF
+        a = ((a + (b<<4) + (b>>4)) * 11) & 0xFFFFFFFF
     a &= 0x1FFFFFFF
     if a <= 2: a += 3
     return a
@@ -485,13 +570,31 @@ COMPR_NONE = 0
 COMPR_LZO = 1
 COMPR_ZLIB = 2
 COMPR_ZSTD = 3
+
+def _lzo_accepts_buffer():
+    """
+    check if this python-lzo version can decompress from a memoryview.
+    """
+    try:
+        return lzo.decompress(memoryview(lzo.compress(b"ubi", False)), False, 3) == b"ubi"
+    except Exception:
+        return False
+
+LZO_ACCEPTS_BUFFER = _lzo_accepts_buffer()
+
 def decompress(data, buflen, compr_type):
+    """
+    `data` can be bytes or a memoryview.
+    """
     if compr_type==COMPR_NONE:
         return data
     elif compr_type==COMPR_LZO:
+        if not LZO_ACCEPTS_BUFFER:
+            data = bytes(data)
         return lzo.decompress(data, False, buflen)
     elif compr_type==COMPR_ZLIB:
-        return zlib.decompress(data, -zlib.MAX_WBITS)
+        # the expected size is known, so zlib can allocate the output buffer once.
+        return zlib.decompress(data, -zlib.MAX_WBITS, buflen)
     elif compr_type==COMPR_ZSTD and zstd:
         return zstd.decompress(data)
     else:
@@ -504,7 +607,9 @@ def compress(data, compr_type):
     elif compr_type==COMPR_LZO:
         return lzo.compress(data, False)
     elif compr_type==COMPR_ZLIB:
-        return zlib.compress(data, -zlib.MAX_WBITS)
+        # ubifs uses raw deflate streams, without the zlib header.
+        c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
     elif compr_type==COMPR_ZSTD and zstd:
         return zstd.compress(data)
     else:
@@ -514,7 +619,138 @@ def compress(data, compr_type):
 # the blocksize is a fixed value, independent of the underlying device.
 UBIFS_BLOCKSIZE = 4096
 
+# consecutive datablocks are combined into writes of at most this size.
+WRITE_CHUNKSIZE = 0x100000
+
+# nr of threads writing extracted files, and the max size of files handed to these threads.
+SAVE_THREADS = 8
+THREADED_MAXSIZE = 0x100000
+
+# files up to this size are loaded in one buffer, and saved with a single write.
+SMALLFILE_MAXSIZE = 0x10000
+
+# flags for os.open of extracted files, O_BINARY is needed on windows.
+SAVE_OPENFLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_CLOEXEC', 0) | getattr(os, 'O_BINARY', 0)
+
+
+def writerun(fd, bufs, ofs):
+    """
+    write the list of buffers `bufs` to file descriptor `fd` at offset `ofs`.
+
+    Usually this takes a single syscall, after a short write the remaining data is written.
+    """
+    bufs = list(bufs)
+    while bufs:
+        if hasattr(os, 'pwritev'):
+            n = os.pwritev(fd, bufs, ofs)
+        elif hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, b"".join(bufs), ofs)
+        else:
+            os.lseek(fd, ofs, os.SEEK_SET)
+            n = os.write(fd, b"".join(bufs))
+        if n == 0:
+            raise OSError(errno.EIO, "short write at offset %d" % ofs)
+        ofs += n
+
+        # drop the part which was written
+        i = 0
+        while i < len(bufs) and n >= len(bufs[i]):
+            n -= len(bufs[i])
+            i += 1
+        del bufs[:i]
+        if n:
+            bufs[0] = memoryview(bufs[0])[n:]
+
+
+def joinblocks(blocks, size):
+    """
+    return the (offset, data) tuples from `blocks` as one buffer, when they
+    exactly cover `size` bytes.
+    Returns None when there are missing blocks, or more data than `size`,
+    those files are saved with writefiledata, which keeps the holes and prints a warning.
+    """
+    pos = 0
+    for ofs, data in blocks:
+        if ofs != pos:
+            return None
+        pos += len(data)
+    if pos != size:
+        return None
+    return bytearray().join(data for _, data in blocks)
+
+
+def writefiledata(fh, inum, size, blocks, ubiname):
+    """
+    write the (offset, data) tuples from `blocks` to the filehandle `fh`,
+    for inode `inum` with filesize `size`.
+    `fh` can also be a file descriptor, as returned by os.open.
+
+    the `ubiname` argument is not needed, except for printing useful error messages.
+
+    When `fh` is a real file, it is first truncated to the inode size, then
+    the datablocks are written with pwritev, leaving holes for missing blocks.
+    Runs of consecutive blocks are combined in one pwritev of up to WRITE_CHUNKSIZE bytes.
+
+    This does not access the filesystem, so it can run in another thread than the b-tree walk.
+    For the same reason it does not print: a warning about the file data is returned,
+    None is returned when there is nothing to report.
+    """
+    fd = None
+    if isinstance(fh, int):
+        fd = fh
+    elif hasattr(os, 'pwrite'):
+        try:
+            fd = fh.fileno()
+        except (AttributeError, OSError):
+            # not a real file, like SeekableStdout
+            pass
+        if fd is not None:
+            fh.flush()
+    if fd is not None:
+        os.ftruncate(fd, size)
+
+    savedlen = 0
+    run = []        # consecutive blocks not written yet
+    runofs = runlen = 0
+    for ofs, data in blocks:
+        if fd is not None:
+            if run and (ofs != runofs + runlen or runlen >= WRITE_CHUNKSIZE):
+                writerun(fd, run, runofs)
+                run = []
+            if not run:
+                runofs, runlen = ofs, 0
+            run.append(data)
+            runlen += len(data)
+        else:
+            fh.seek(ofs)
+            fh.write(data)
+        savedlen += len(data)
+    if run:
+        writerun(fd, run, runofs)
+
+    if savedlen > size:
+        return "WARNING: found more (%d bytes) for inode %05d, than specified in the inode(%d bytes) -- %s" % (savedlen, inum, size, ubiname)
+    elif savedlen < size and fd is None:
+        # padding file with zeros
+        fh.seek(size)
+        fh.truncate(size)
+
 ########### objects for the various node types ########### 
+_INODE_S = struct.Struct("<16s5Q11L4xLH26x")
+_DEVNUM_S = struct.Struct("BB")
+_DATA_S = struct.Struct("<16sLH2x")
+_DIRENT_S = struct.Struct("<16sQxBH4x")
+_TRUNC_S = struct.Struct("<L12xQQ")
+_PAD_S = struct.Struct("<L")
+_SB_S = struct.Struct("<2xBB5LQ7LH2xLLQL16sL")
+_MST_S = struct.Struct("<QQ8L6Q12L")
+_REF_S = struct.Struct("<3L28x")
+_BRANCH_S = struct.Struct("<3L")
+_BRANCHKEY_S = struct.Struct("<3L8s")
+_IDX_S = struct.Struct("<HH")
+_CMT_S = struct.Struct("<Q")
+_CH_S = struct.Struct("<LLQLBB2x")
+
 class UbiFsInode:
     """
     Leafnode in the B-tree, contains information for a specific file or directory.
@@ -562,7 +798,7 @@ class UbiFsInode:
         self.xattr_names,  # L
         self.compr_type    # H
                            # 26x
-        ) = struct.unpack("<16s5Q11L4xLH26x", data[:self.hdrsize])
+        ) = _INODE_S.unpack_from(data, 0)
 
         # data contains the symlink string for symbolic links
         self.data = data[self.hdrsize:]
@@ -570,7 +806,7 @@ class UbiFsInode:
             raise Exception("inode data size mismatch")
 
     def encode(self):
-        return struct.pack("<16s5Q11L4xLH26x", \
+        return _INODE_S.pack( \
                 self.key, self.creat_sqnum, self.size, self.atime_sec, self.ctime_sec, self.mtime_sec, \
                 self.atime_nsec, self.ctime_nsec, self.mtime_nsec, self.nlink, self.uid, self.gid, \
                 self.mode, self.flags, self.data_len, self.xattr_cnt, self.xattr_size, \
@@ -596,7 +832,7 @@ class UbiFsInode:
     def ctime(self):
         return self.ctime_sec + self.ctime_nsec / 1000000000.0
     def devnum(self):
-        ma, mi = struct.unpack("BB", self.data[:2])
+        ma, mi = _DEVNUM_S.unpack_from(self.data, 0)
         return (ma, mi)
     def nodetype(self):
         return (self.mode >> 12) & 0xF
@@ -621,13 +857,14 @@ class UbiFsData:
         self.size,       # L
         self.compr_type, # H
                          # 2x
-        )= struct.unpack("<16sLH2x", data[:self.hdrsize])
-        self.data = decompress(data[self.hdrsize:], self.size, self.compr_type)
+        )= _DATA_S.unpack_from(data, 0)
+        # pass a view, so the compressed data is not copied.
+        self.data = decompress(memoryview(data)[self.hdrsize:], self.size, self.compr_type)
         if len(self.data) != self.size:
             raise Exception("data size mismatch")
 
     def encode(self):
-        return struct.pack("<16sLH2x", self.key, len(self.data), self.compr_type) + compress(self.data, self.compr_type)
+        return _DATA_S.pack(self.key, len(self.data), self.compr_type) + compress(self.data, self.compr_type)
 
     def __repr__(self):
         return "DATA: key=%s, size=%d, comp=%d" % (formatkey(self.key), self.size, self.compr_type)
@@ -671,12 +908,12 @@ class UbiFsDirEntry:
             self.type, # B
             nlen,      # H
                        # 4x
-        ) = struct.unpack("<16sQxBH4x", data[:self.hdrsize])
+        ) = _DIRENT_S.unpack_from(data, 0)
         self.name = data[self.hdrsize:-1]
         if len(self.name) != nlen:
             raise Exception("name length mismatch")
     def encode(self):
-        return struct.pack("<16sQxBH4x", self.key, self.inum, self.type, nlen)
+        return _DIRENT_S.pack(self.key, self.inum, self.type, nlen)
     def __repr__(self):
         typenames = [ 'reg', 'dir', 'lnk', 'blk', 'chr', 'fifo', 'sock' ]
         # type: UBIFS_ITYPE_REG, UBIFS_ITYPE_DIR, etc
@@ -717,9 +954,9 @@ class UbiFsTruncation:
                            # 12x
             self.old_size, # Q
             self.new_size, # Q
-        ) = struct.unpack("<L12xQQ", data)
+        ) = _TRUNC_S.unpack_from(data, 0)
     def encode(self):
-        return struct.pack("<L12xQQ", self.inum, self.old_size, self.new_size)
+        return _TRUNC_S.pack(self.inum, self.old_size, self.new_size)
     def __repr__(self):
         return "TRUNC: inum:%05d, size:%d->%d" % (self.inum, self.old_size, self.new_size)
 
@@ -732,9 +969,9 @@ class UbiFsPadding:
     def __init__(self):
         pass
     def parse(self, data):
-        self.pad_len, = struct.unpack_from("<L", data, 0)
+        self.pad_len, = _PAD_S.unpack_from(data, 0)
     def encode(self):
-        return struct.pack("<L", self.pad_len)
+        return _PAD_S.pack(self.pad_len)
     def __repr__(self):
         return "PAD: padlen=%d" % self.pad_len
 
@@ -773,11 +1010,11 @@ class UbiFsSuperblock:
         self.time_gran,             # L
         self.uuid,                  # 16s
         self.ro_compat_version,     # L
-        ) = struct.unpack("<2xBB5LQ7LH2xLLQL16sL", data[:self.hdrsize])
+        ) = _SB_S.unpack_from(data, 0)
         if len(data) != self.hdrsize + 3968:
             raise Exception("invalid superblock padding size")
     def encode(self):
-        return struct.pack("<2xBB5LQ7LH2xLLQL16sL", 
+        return _SB_S.pack(
                 self.key_hash, self.key_fmt, self.flags, self.min_io_size, self.leb_size, self.leb_cnt, \
                 self.max_leb_cnt, self.max_bud_bytes, self.log_lebs, self.lpt_lebs, self.orph_lebs, \
                 self.jhead_cnt, self.fanout, self.lsave_cnt, self.fmt_version, self.default_compr, \
@@ -831,12 +1068,12 @@ class UbiFsMaster:
         self.empty_lebs,   # L
         self.idx_lebs,     # L
         self.leb_cnt,      # L
-        ) = struct.unpack("<QQ8L6Q12L", data[:self.hdrsize])
+        ) = _MST_S.unpack_from(data, 0)
         if len(data) != self.hdrsize + 344:
             raise Exception("invalid master padding size")
 
     def encode(self):
-        return struct.pack("<QQ8L6Q12L", self.highest_inum, self.cmt_no, self.flags, self.log_lnum, self.root_lnum, self.root_offs, \
+        return _MST_S.pack(self.highest_inum, self.cmt_no, self.flags, self.log_lnum, self.root_lnum, self.root_offs, \
                 self.root_len, self.gc_lnum, self.ihead_lnum, self.ihead_offs, self.index_size, \
                 self.total_free, self.total_dirty, self.total_used, self.total_dead, \
                 self.total_dark, self.lpt_lnum, self.lpt_offs, self.nhead_lnum, self.nhead_offs, \
@@ -863,9 +1100,9 @@ class UbiFsLEBReference:
     def __init__(self):
         pass
     def parse(self, data):
-        self.lnum, self.offs, self.jhead = struct.unpack("<3L28x", data)
+        self.lnum, self.offs, self.jhead = _REF_S.unpack_from(data, 0)
     def encode(self):
-        return struct.pack("<3L28x", self.lnum, self.offs, self.jhead)
+        return _REF_S.pack(self.lnum, self.offs, self.jhead)
     def __repr__(self):
         return "REF: ref=[%03d:0x%05x], jhead=%d" % (self.lnum, self.offs, self.jhead)
 
@@ -882,28 +1119,32 @@ class UbiFsIndex:
         def __init__(self):
             pass
         def parse(self, data):
-            self.lnum, self.offs, self.len = struct.unpack("<3L", data[:self.hdrsize])
+            self.lnum, self.offs, self.len = _BRANCH_S.unpack_from(data, 0)
             self.key = data[self.hdrsize:]
+            self.ikey = intkey(self.key)
         def encode(self):
-            return struct.pack("<3L", self.lnum, self.offs, self.len) + self.key
+            return _BRANCH_S.pack(self.lnum, self.offs, self.len) + self.key
         def __repr__(self):
             return "BRANCH: ref=[%03d:0x%05x] len=%4d -- key=%s" % (self.lnum, self.offs, self.len, formatkey(self.key))
 
     def __init__(self):
         pass
     def parse(self, data):
-        self.child_cnt, self.level = struct.unpack("<HH", data[:self.hdrsize])
+        self.child_cnt, self.level = _IDX_S.unpack_from(data, 0)
+        end = self.hdrsize + self.child_cnt * _BRANCHKEY_S.size
+        if end > len(data):
+            raise Exception("parse error")
+
+        # decode all branches in one go, instead of slicing and parsing each branch.
         self.branches = []
-        o = self.hdrsize
-        for _ in range(self.child_cnt):
-            if o >= len(data):
-                raise Exception("parse error")
+        for lnum, offs, size, key in _BRANCHKEY_S.iter_unpack(memoryview(data)[self.hdrsize:end]):
             branch = self.Branch()
-            branch.parse(data[o:o+branch.hdrsize])  ; o += branch.hdrsize
-            branch.key = data[o:o+8]     ; o += 8
+            branch.lnum, branch.offs, branch.len, branch.key = lnum, offs, size, key
+            branch.ikey = intkey(key)
             self.branches.append(branch)
+        self.ikeys = [b.ikey for b in self.branches]
     def encode(self):
-        data = struct.pack("<HH", self.child_cnt, self.level)
+        data = _IDX_S.pack(self.child_cnt, self.level)
         for _ in self.branches:
             data += _.encode()
         return data
@@ -931,22 +1172,16 @@ class UbiFsIndex:
         add two more options for every next branch.
 
         """
-        for i, b in enumerate(self.branches):
-            c = comparekeys(key, b.key)
-            if c<0:
-                if i==0:
-                    # before first item
-                    return ('lt', i)
-                else:
-                    # between prev and this item
-                    return ('gt', i-1)
-            elif c==0:
-                # found item
-                return ('eq', i)
-            # else c>0 -> continue searching
-
-        # after last item
-        return ('gt', i)
+        ikey = intkey(key)
+        i = bisect_left(self.ikeys, ikey)
+        if i<len(self.ikeys) and self.ikeys[i]==ikey:
+            # found item
+            return ('eq', i)
+        if i==0:
+            # before first item
+            return ('lt', i)
+        # between prev and this item, or after the last item
+        return ('gt', i-1)
 
 
 
@@ -956,9 +1191,9 @@ class UbiFsCommitStart:
     def __init__(self):
         pass
     def parse(self, data):
-        self.cmt_no, = struct.unpack("<Q", data[:self.hdrsize])
+        self.cmt_no, = _CMT_S.unpack_from(data, 0)
     def encode(self):
-        return struct.pack("<Q", self.cmt_no)
+        return _CMT_S.pack(self.cmt_no)
     def __repr__(self):
         return "COMMIT: cmt=%d" % self.cmt_no
 
@@ -969,10 +1204,10 @@ class UbiFsOrphan:
     def __init__(self):
         pass
     def parse(self, data):
-        self.cmt_no, = struct.unpack("<Q", data[:self.hdrsize])
+        self.cmt_no, = _CMT_S.unpack_from(data, 0)
         # todo: inos
     def encode(self):
-        return struct.pack("<Q", self.cmt_no)
+        return _CMT_S.pack(self.cmt_no)
     def __repr__(self):
         return "ORPHAN: cmt=%d" % self.cmt_no
 
@@ -1009,7 +1244,7 @@ class UbiFsCommonHeader:
         self.node_type,    # 14  B
         self.group_type,   # 15  B
                            # 16  2x
-        ) = struct.unpack("<LLQLBB2x", data)
+        ) = _CH_S.unpack_from(data, 0)
         if self.magic != 0x06101831:
             if self.magic in (0x73717368, 0x68737173):
                 print("volume contains a squashfs filesystem, extract with --saveraw, and then use unsquashfs")
@@ -1017,7 +1252,7 @@ class UbiFsCommonHeader:
                 print("unknown magic: %08x" % self.magic)
             raise Exception("node magic num mismatch")
     def encode(self):
-        return struct.pack("<LLQLBB2x", self.magic, self.crc, self.sqnum, self.len, self.node_type, self.group_type)
+        return _CH_S.pack(self.magic, self.crc, self.sqnum, self.len, self.node_type, self.group_type)
 
     def getnode(self):
         """
@@ -1041,11 +1276,34 @@ class UbiFs:
 
     the filesystem consists of a b-tree containing inodes, direntry and data nodes.
     """
-    def __init__(self, vol, masteroffset):
+    # max nr of index nodes kept in the node cache
+    NODECACHE_SIZE = 1024
+
+    # max nr of inodes kept in the inode cache
+    INODECACHE_SIZE = 4096
+
+    # the readahead window grows from min to max size while nodes are read sequentially
+    READAHEAD_MIN = 0x2000
+    READAHEAD_MAX = 0x40000
+
+    def __init__(self, vol, masteroffset, readahead=True, verify_crc=True):
         """
         The constructor takes a UbiVolume or RawVolume object
+
+        `readahead` enables buffering of the data following sequentially read nodes,
+        this is only used when the volume does seek+read I/O, not for a mmapped image.
+        `verify_crc` can be disabled to skip checking the crc of each node read.
         """
         self.vol = vol
+        self.verify_crc = verify_crc
+        self._nodecache = OrderedDict()
+        self._inodecache = OrderedDict()
+
+        self.readahead = readahead and bool(vol.leb_size) and not vol.mapped
+        self._rabuf = None        # (lnum, offs, data)
+        self._ralast = None       # (lnum, offs) of the last node read
+        self._raseq = 0
+        self._rasize = self.READAHEAD_MIN
 
         self.load(masteroffset)
 
@@ -1079,26 +1337,88 @@ class UbiFs:
     def readnode(self, lnum, offs):
         """
         read a node from a lnum + offset.
+
+        Index nodes are kept in a LRU cache, since the upper levels of the b-tree
+        are read again for every lookup. Cached nodes are not crc checked again.
         """
+        node = self._nodecache.get((lnum, offs))
+        if node is not None:
+            self._nodecache.move_to_end((lnum, offs))
+            return node
+
+        if self.readahead:
+            self.tracksequential(lnum, offs)
+
         ch = UbiFsCommonHeader()
-        hdrdata = self.vol.read(lnum, offs, ch.hdrsize)
+        hdrdata = self.readbytes(lnum, offs, ch.hdrsize)
         ch.parse(hdrdata)
 
         ch.lnum = lnum
         ch.offs = offs
 
         node = ch.getnode()
-        nodedata = self.vol.read(lnum, offs + ch.hdrsize, ch.len - ch.hdrsize)
-
-        if crc32(hdrdata[8:] + nodedata) != ch.crc:
-            node.parse(nodedata)
-            print(ch, node)
-            print(" %s + %s = %08x -> want = %08x" % ( b2a_hex(hdrdata), b2a_hex(nodedata), crc32(hdrdata[8:] + nodedata), ch.crc))
-            raise Exception("invalid node crc")
+        nodedata = self.readbytes(lnum, offs + ch.hdrsize, ch.len - ch.hdrsize)
+
+        if self.verify_crc:
+            nodecrc = crc32(nodedata, crc32(hdrdata[8:]))
+            if nodecrc != ch.crc:
+                node.parse(nodedata)
+                print(ch, node)
+                print(" %s + %s = %08x -> want = %08x" % ( b2a_hex(hdrdata), b2a_hex(nodedata), nodecrc, ch.crc))
+                raise Exception("invalid node crc")
         node.parse(nodedata)
 
+        if isinstance(node, UbiFsIndex):
+            self._nodecache[(lnum, offs)] = node
+            if len(self._nodecache) > self.NODECACHE_SIZE:
+                self._nodecache.popitem(last=False)
+
         return node
 
+    def tracksequential(self, lnum, offs):
+        """
+        Detect nodes being read in increasing order from the same leb.
+
+        From the 3rd sequential node on, the rest of the leb is read ahead,
+        in chunks which double in size, up to READAHEAD_MAX.
+        """
+        if offs >= self.vol.leb_size:
+            # past the end of the leb, like the master node scan does: nothing to read ahead.
+            self._ralast = None
+            self._raseq = 0
+            self._rasize = self.READAHEAD_MIN
+            return
+
+        if self._ralast and self._ralast[0]==lnum and offs > self._ralast[1]:
+            self._raseq += 1
+        else:
+            self._raseq = 0
+            self._rasize = self.READAHEAD_MIN
+        self._ralast = (lnum, offs)
+
+        if self._raseq >= 2 and not self.inreadahead(lnum, offs, UbiFsCommonHeader.hdrsize):
+            size = min(self._rasize, self.vol.leb_size - offs)
+            self._rabuf = (lnum, offs, self.vol.read(lnum, offs, size))
+            self._rasize = min(2*self._rasize, self.READAHEAD_MAX)
+
+    def inreadahead(self, lnum, offs, size):
+        """
+        check if the readahead buffer contains the specified range
+        """
+        if not self._rabuf:
+            return False
+        ralnum, raoffs, radata = self._rabuf
+        return lnum==ralnum and raoffs <= offs and offs+size <= raoffs+len(radata)
+
+    def readbytes(self, lnum, offs, size):
+        """
+        read from the volume, or from the readahead buffer when it contains the requested range.
+        """
+        if self.inreadahead(lnum, offs, size):
+            _, raoffs, radata = self._rabuf
+            return radata[offs-raoffs:offs-raoffs+size]
+        return self.vol.read(lnum, offs, size)
+
     def writenode(self, node):
         """
         Write a node from a lnum + offset.
@@ -1111,9 +1431,13 @@ class UbiFs:
         node.hdr.len = len(nodedata) + node.hdr.hdrsize
         hdrdata = node.hdr.encode()
 
-        node.hdr.crc = crc32(hdrdata[8:] + nodedata)
+        node.hdr.crc = crc32(nodedata, crc32(hdrdata[8:]))
         hdrdata = node.hdr.encode()
 
+        self._nodecache.pop((node.hdr.lnum, node.hdr.offs), None)
+        if isinstance(node, UbiFsInode):
+            self._inodecache.pop(unpackkey(node.key)[0], None)
+        self._rabuf = None
         self.vol.write(node.hdr.lnum, node.hdr.offs, hdrdata+nodedata)
 
     def dumpnode(self, lnum, offs):
@@ -1197,41 +1521,47 @@ class UbiFs:
 
         def next(self):
             """ move cursor to next entry """
-            if not self.stack:
+            stack = self.stack
+            readnode = self.fs.readnode
+            if not stack:
                 # starting at 'eof'
                 page = self.fs.root
                 ix = 0
             else:
-                page, ix = self.stack.pop()
-                while self.stack and ix==len(page.branches)-1:
-                    page, ix = self.stack.pop()
+                page, ix = stack.pop()
+                while stack and ix==len(page.branches)-1:
+                    page, ix = stack.pop()
                 if ix==len(page.branches)-1:
                     return
                 ix += 1
-            self.stack.append( (page, ix) )
+            stack.append( (page, ix) )
             while page.level:
-                page = self.fs.readnode(page.branches[ix].lnum, page.branches[ix].offs)
+                b = page.branches[ix]
+                page = readnode(b.lnum, b.offs)
                 ix = 0
-                self.stack.append( (page, ix) )
+                stack.append( (page, ix) )
 
         def prev(self):
             """ move cursor to next entry """
-            if not self.stack:
+            stack = self.stack
+            readnode = self.fs.readnode
+            if not stack:
                 # starting at 'eof'
                 page = self.fs.root
                 ix = len(page.branches)-1
             else:
-                page, ix = self.stack.pop()
-                while self.stack and ix==0:
-                    page, ix = self.stack.pop()
+                page, ix = stack.pop()
+                while stack and ix==0:
+                    page, ix = stack.pop()
                 if ix==0:
                     return
                 ix -= 1
-            self.stack.append( (page, ix) )
+            stack.append( (page, ix) )
             while page.level:
-                page = self.fs.readnode(page.branches[ix].lnum, page.branches[ix].offs)
+                b = page.branches[ix]
+                page = readnode(b.lnum, b.offs)
                 ix = len(page.branches)-1
-                self.stack.append( (page, ix) )
+                stack.append( (page, ix) )
         def eof(self):
             return len(self.stack)==0
         def __repr__(self):
@@ -1241,17 +1571,20 @@ class UbiFs:
             """
             Returns the key tuple for the current item
             """
-            if self.stack:
-                page, ix = self.stack[-1]
-                return unpackkey(page.branches[ix].key)
+            if not self.stack:
+                return None
+            page, ix = self.stack[-1]
+            return unpackkey(page.branches[ix].key)
 
         def getnode(self):
             """
             Returns the node object for the current item
             """
-            if self.stack:
-                page, ix = self.stack[-1]
-                return self.fs.readnode(page.branches[ix].lnum, page.branches[ix].offs)
+            if not self.stack:
+                return None
+            page, ix = self.stack[-1]
+            b = page.branches[ix]
+            return self.fs.readnode(b.lnum, b.offs)
 
 
     def find(self, rel, key, root=None):
@@ -1265,13 +1598,15 @@ class UbiFs:
         """
         stack = []
         page = self.root if root is None else root
+        pkey = packkey(key)
 
         while len(stack)<32:
-            act, ix = page.find(packkey(key))
+            act, ix = page.find(pkey)
             stack.append( (page, ix) )
             if page.level==0:
                 break
-            page = self.readnode(page.branches[ix].lnum, page.branches[ix].offs)
+            b = page.branches[ix]
+            page = self.readnode(b.lnum, b.offs)
 
         if len(stack)==32:
             raise Exception("tree too deep")
@@ -1302,58 +1637,97 @@ class UbiFs:
         pass
         #todo - adding a 
 
+    def iter_range(self, startkey, endkey, root=None):
+        """
+        yield (key, node) for all b-tree items with startkey <= key < endkey.
+
+        The items are taken directly from the branches of the current leaf index node,
+        the cursor only moves through the tree when moving to the next leaf.
+        The end of the range within a leaf is found by bisecting the leaf's integer keys.
+        """
+        c = self.find('ge', startkey, root)
+        iendkey = intkey(packkey(endkey))
+        readnode = self.readnode
+        while not c.eof():
+            page, ix = c.stack[-1]
+            end = bisect_left(page.ikeys, iendkey, ix)
+            for b in page.branches[ix:end]:
+                yield unpackkey(b.key), readnode(b.lnum, b.offs)
+            if end < len(page.branches):
+                return
+
+            # continue at the first item of the next leaf
+            c.stack[-1] = (page, len(page.branches)-1)
+            c.next()
+
 
     def recursefiles(self, inum, path, filter = 1<<UbiFsDirEntry.TYPE_REGULAR, root=None):
         """
         Recursively yield all files below the directory with inode `inum`
+
+        The directories are walked depth first, using a stack of iter_range iterators,
+        one for each directory being listed, instead of nested generators.
         """
-        startkey = (inum, UBIFS_DENT_KEY, 0)
-        endkey = (inum, UBIFS_DENT_KEY+1, 0)
         if root is None:
             root = self.root
-        c = self.find('ge', startkey, root)
-        while not c.eof() and c.getkey() < endkey:
-            ent = c.getnode()
 
-            if filter & (1<<ent.type):
-                yield ent.inum, path + [ent.name]
-            if ent.type==ent.TYPE_DIRECTORY:
-                # recurse into subdirs
-                for x in self.recursefiles(ent.inum, path + [ent.name], filter, root):
-                    yield x
-
-            c.next()
+        def opendir(inum, path):
+            return self.iter_range((inum, UBIFS_DENT_KEY, 0), (inum, UBIFS_DENT_KEY+1, 0), root), path
+
+        stack = [ opendir(inum, path) ]
+        while stack:
+            entries, dirpath = stack[-1]
+            for _, ent in entries:
+                entpath = dirpath + [ent.name]
+                if filter & (1<<ent.type):
+                    yield ent.inum, entpath
+                if ent.type==ent.TYPE_DIRECTORY:
+                    # continue with the subdir, before the rest of this directory
+                    stack.append(opendir(ent.inum, entpath))
+                    break
+            else:
+                stack.pop()
 
-    def exportfile(self, inum, fh, ubiname):
+    def getinode(self, inum):
         """
-        save file data from inode `inum` to the filehandle `fh`.
+        return the inode node for `inum`, or None when not found.
 
-        the `ubiname` argument is not needed, except for printing useful error messages.
+        Recently used inodes are kept in a cache, so the b-tree is not
+        searched again when an inode is needed more than once.
         """
-        startkey = (inum, UBIFS_DATA_KEY, 0)
-        endkey = (inum, UBIFS_DATA_KEY+1, 0)
-        c = self.find('ge', startkey)
+        inode = self._inodecache.get(inum)
+        if inode is not None:
+            self._inodecache.move_to_end(inum)
+            return inode
 
-        savedlen = 0
-        while not c.eof() and c.getkey() < endkey:
-            dat = c.getnode()
-            _, _, blocknum = c.getkey()
+        c = self.find('eq', (inum, UBIFS_INO_KEY, 0))
+        if not c:
+            return None
+        inode = c.getnode()
 
-            fh.seek(UBIFS_BLOCKSIZE * blocknum)
+        self._inodecache[inum] = inode
+        if len(self._inodecache) > self.INODECACHE_SIZE:
+            self._inodecache.popitem(last=False)
+        return inode
 
-            fh.write(dat.data)
-            savedlen += len(dat.data)
+    def filedata(self, inum):
+        """
+        yield (offset, data) for all datablocks of inode `inum`
+        """
+        for (_, _, blocknum), dat in self.iter_range((inum, UBIFS_DATA_KEY, 0), (inum, UBIFS_DATA_KEY+1, 0)):
+            yield UBIFS_BLOCKSIZE * blocknum, dat.data
 
-            c.next()
+    def exportfile(self, inum, fh, ubiname):
+        """
+        save file data from inode `inum` to the filehandle or file descriptor `fh`.
 
-        c = self.find('eq', (inum, UBIFS_INO_KEY, 0))
-        inode = c.getnode()
-        if savedlen > inode.size:
-            print("WARNING: found more (%d bytes) for inode %05d, than specified in the inode(%d bytes) -- %s" % (savedlen, inum, inode.size, ubiname))
-        elif savedlen < inode.size:
-            # padding file with zeros
-            fh.seek(inode.size)
-            fh.truncate(inode.size)
+        the `ubiname` argument is not needed, except for printing useful error messages.
+        """
+        inode = self.getinode(inum)
+
+        warning = writefiledata(fh, inum, inode.size, self.filedata(inum), ubiname)
+        if warning:
+            print(warning)
 
     def findfile(self, path, inum = 1):
         """
@@ -1375,6 +1749,7 @@ class UbiFs:
         return inum
 
 
+@functools.lru_cache(maxsize=4096)
 def modestring(mode):
     """
     return a "-rw-r--r--" style mode string
@@ -1396,6 +1771,7 @@ def modestring(mode):
     return typechar[(mode>>12)&15] + rwx((mode>>6)&7, (mode>>11)&1, 's') + rwx((mode>>3)&7, (mode>>10)&1, 's') + rwx(mode&7, (mode>>9)&1, 't')
 
 
+@functools.lru_cache(maxsize=4096)
 def timestring(t):
     return datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
 
@@ -1411,7 +1787,7 @@ def processvolume(vol, volumename, args):
     """
     nr_symlink_warnings = 0
 
-    fs = UbiFs(vol, args.masteroffset)
+    fs = UbiFs(vol, args.masteroffset, verify_crc=not args.no_verify)
     if args.verbose:
         fs.dumpfs()
 
@@ -1436,58 +1812,15 @@ def processvolume(vol, volumename, args):
     if args.savedir:
         savedir = args.savedir.encode(args.encoding)
 
-        os.makedirs(savedir.decode(args.encoding) + '/' + volumename.decode(args.encoding), exist_ok=True)
-        count = 0
-        for inum, path in fs.recursefiles(1, [], UbiFsDirEntry.ALL_TYPES, root=root):
-            c = fs.find('eq', (inum, UBIFS_INO_KEY, 0))
-            inode = c.getnode()
-            typ = inode.nodetype()
-
-            fullpath = os.path.join(*[savedir, volumename] + path)
-            try:
-                if typ ==  inode.ITYPE_FIFO:
-                    os.mkfifo(fullpath)
-                elif typ ==  inode.ITYPE_SOCKET:
-                    import socket as s
-                    sock = s.socket(s.AF_UNIX)
-                    sock.bind(fullpath)
-                elif typ == inode.ITYPE_SYMLINK:
-                    try:
-                        os.symlink(inode.data, fullpath)
-                    except (AttributeError, OSError):
-                        # python2 on windows does not support 'symlink', and with python3
-                        # you still need special permissions to create a symlink. So often
-                        # on windows os.symlink will fail.
-                        nr_symlink_warnings += 1
-                elif typ == inode.ITYPE_DIRECTORY:
-                    os.makedirs(fullpath)
-                elif typ == inode.ITYPE_REGULAR:
-                    with open(fullpath, "wb") as fh:
-                        fs.exportfile(inum, fh, os.path.join(*path))
-                elif typ in (inode.ITYPE_BLOCKDEV, inode.ITYPE_CHARDEV):
-                    try:
-                        devnum = os.makedev(*inode.devnum())
-                        if devnum < 0:
-                            devnum += 0x100000000
-                        os.mknod(fullpath, inode.mode, devnum)
-                    except PermissionError as e:
-                        # silently ignoring permission error
-                        pass
-                else:
-                    if args.verbose:
-                        print("UNKNOWN inode type: %d" % typ)
-                    continue
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    print(f"ERROR writing {fullpath}, {e}")
-            except Exception as e:
-                print(f"ERROR writing {fullpath}, {e}")
-
-            if args.preserve and typ != inode.ITYPE_SYMLINK and os.path.exists(fullpath):
+        def restoreattrs(fullpath, inode, typ):
+            if args.preserve and typ != inode.ITYPE_SYMLINK:
                 # note: we have to do this after closing the file, since the close after exportfile
                 # will update the last-modified time.
-                # the check for existence is because earlier mknod may fail when not root.
-                os.utime(fullpath, (inode.atime(), inode.mtime()))
+                try:
+                    os.utime(fullpath, (inode.atime(), inode.mtime()))
+                except FileNotFoundError:
+                    # an earlier mknod may fail when not root.
+                    return
                 os.chmod(fullpath, inode.mode)
                 try:
                     os.chown(fullpath, inode.uid, inode.gid)
@@ -1495,15 +1828,119 @@ def processvolume(vol, volumename, args):
                     # silently ignoring permission error
                     pass
 
-            count += 1
+        def savefile(fullpath, inum, inode, blocks, ubiname):
+            """
+            `blocks` is either the complete file contents, or a list of (offset, data) tuples
+
+            This runs in a worker thread, errors and warnings are returned as a message,
+            which is printed by the main thread.
+            """
+            warning = None
+            try:
+                fd = os.open(fullpath, SAVE_OPENFLAGS, 0o666)
+                try:
+                    if isinstance(blocks, bytearray):
+                        view = memoryview(blocks)
+                        while view:
+                            view = view[os.write(fd, view):]
+                    else:
+                        warning = writefiledata(fd, inum, inode.size, blocks, ubiname)
+                finally:
+                    os.close(fd)
+            except Exception as e:
+                return f"ERROR writing {fullpath}, {e}"
+            try:
+                restoreattrs(fullpath, inode, inode.ITYPE_REGULAR)
+            except Exception as e:
+                msg = f"ERROR setting attributes of {fullpath}, {e}"
+                return msg if warning is None else warning + "\n" + msg
+            return warning
+
+        def reportsaved(future):
+            msg = future.result()
+            if msg:
+                print(msg)
+
+        volumedir = os.path.join(savedir, volumename)
+        os.makedirs(volumedir, exist_ok=True)
+        count = 0
+        # the b-tree walk and decompression stay in this thread, since UbiFs is not thread safe.
+        # small files are handed to the pool for writing, larger files are streamed from here.
+        pending = deque()
+        with ThreadPoolExecutor(SAVE_THREADS) as pool:
+            for inum, path in fs.recursefiles(1, [], UbiFsDirEntry.ALL_TYPES, root=root):
+                inode = fs.getinode(inum)
+                typ = inode.nodetype()
+
+                fullpath = os.path.join(volumedir, *path)
+                try:
+                    if typ ==  inode.ITYPE_FIFO:
+                        os.mkfifo(fullpath)
+                    elif typ ==  inode.ITYPE_SOCKET:
+                        import socket as s
+                        sock = s.socket(s.AF_UNIX)
+                        sock.bind(fullpath)
+                    elif typ == inode.ITYPE_SYMLINK:
+                        try:
+                            os.symlink(inode.data, fullpath)
+                        except (AttributeError, OSError):
+                            # python2 on windows does not support 'symlink', and with python3
+                            # you still need special permissions to create a symlink. So often
+                            # on windows os.symlink will fail.
+                            nr_symlink_warnings += 1
+                    elif typ == inode.ITYPE_DIRECTORY:
+                        # recursefiles yields a directory before its contents, so the parent
+                        # always exists already, and a plain mkdir is enough.
+                        os.mkdir(fullpath)
+                    elif typ == inode.ITYPE_REGULAR and inode.size <= THREADED_MAXSIZE:
+                        blocks = list(fs.filedata(inum))
+                        if inode.size <= SMALLFILE_MAXSIZE:
+                            data = joinblocks(blocks, inode.size)
+                            if data is not None:
+                                blocks = data
+                        pending.append(pool.submit(savefile, fullpath, inum, inode, blocks, os.path.join(*path)))
+                        if len(pending) > 4 * SAVE_THREADS:
+                            # limit the amount of file data waiting to be written
+                            reportsaved(pending.popleft())
+                        count += 1
+                        continue
+                    elif typ == inode.ITYPE_REGULAR:
+                        fd = os.open(fullpath, SAVE_OPENFLAGS, 0o666)
+                        try:
+                            fs.exportfile(inum, fd, os.path.join(*path))
+                        finally:
+                            os.close(fd)
+                    elif typ in (inode.ITYPE_BLOCKDEV, inode.ITYPE_CHARDEV):
+                        try:
+                            devnum = os.makedev(*inode.devnum())
+                            if devnum < 0:
+                                devnum += 0x100000000
+                            os.mknod(fullpath, inode.mode, devnum)
+                        except PermissionError as e:
+                            # silently ignoring permission error
+                            pass
+                    else:
+                        if args.verbose:
+                            print("UNKNOWN inode type: %d" % typ)
+                        continue
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        print(f"ERROR writing {fullpath}, {e}")
+                except Exception as e:
+                    print(f"ERROR writing {fullpath}, {e}")
+
+                restoreattrs(fullpath, inode, typ)
+                count += 1
+
+            while pending:
+                reportsaved(pending.popleft())
         print("saved %d files" % count)
         if nr_symlink_warnings:
             print("Failed to create %d symlinks." % nr_symlink_warnings)
 
     if args.listfiles:
         for inum, path in fs.recursefiles(1, [], UbiFsDirEntry.ALL_TYPES, root=root):
-            c = fs.find('eq', (inum, UBIFS_INO_KEY, 0))
-            inode = c.getnode()
+            inode = fs.getinode(inum)
 
             if inode.nodetype() in (inode.ITYPE_CHARDEV, inode.ITYPE_BLOCKDEV):   # char or block dev.
                 sizestr = "%d,%4d" % inode.devnum()
@@ -1521,7 +1958,7 @@ def processvolume(vol, volumename, args):
             filename = b"/".join(path)
             if args.encoding:
                 filename = filename.decode(args.encoding, 'ignore')
-            print("%s %2d %-5d %-5d %10s %s %s%s" % (modestring(inode.mode), inode.nlink, inode.uid, inode.gid, sizestr, timestring(inode.mtime_sec), filename, linkstr))
+            print(f"{modestring(inode.mode)} {inode.nlink:2d} {inode.uid:<5d} {inode.gid:<5d} {sizestr:>10s} {timestring(inode.mtime_sec)} {filename}{linkstr}")
 
     for srcfile in args.cat:
         if len(args.cat)>1:
@@ -1713,6 +2150,7 @@ def main():
     parser.add_argument('--dumptree', '-d',  action='store_true', help="dump the filesystem b-tree contents")
     parser.add_argument('--verbose', '-v',  action='count', help="print extra info, like volume map")
     parser.add_argument('--debug',  action='store_true', help="abort on exceptions")
+    parser.add_argument('--no-verify',  action='store_true', help="don't check the crc of filesystem nodes")
     parser.add_argument('--encoding', '-e',  type=str, help="filename encoding, default=utf-8", default='utf-8')
     parser.add_argument('--masteroffset', '-m',  type=str, help="Which master node to use.")
     parser.add_argument('--root', '-R',  type=str, help="Which Root node to use (hexlnum:hexoffset).")